@@ -1,8 +1,18 @@
 import os
+import re
 import logging
 import asyncio
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import yt_dlp
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import yt_dlp.utils
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -10,6 +20,7 @@ from telegram.ext import (
     ContextTypes,
     filters
 )
+from telegram.request import HTTPXRequest
 
 # Logging
 logging.basicConfig(
@@ -18,31 +29,234 @@ logging.basicConfig(
 )
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("Please set BOT_TOKEN environment variable.")
 
 MAX_FILE_SIZE = 45 * 1024 * 1024  # ~45MB safe limit for Telegram bots
+FRAGMENT_THREADS = int(os.environ.get("YTDLP_FRAGS", "8"))  # parallel HLS/DASH fragments
+HTTP_CHUNK_SIZE = 10 * 1024 * 1024  # 10MB ranged requests
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_DL", "4"))
+EXECUTOR_WORKERS = 8
+CACHE_DIR = os.path.join(
+    os.environ.get("CACHE_DIR", os.path.join(tempfile.gettempdir(), "ytdlp_cache")), ""
+)
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_GB", "2")) * 1024 * 1024 * 1024
+STALE_PART_AGE = 10 * 60  # seconds before an unfinished download is abandoned
+REAP_INTERVAL = 5 * 60
+UPLOAD_WRITE_TIMEOUT = 600  # seconds; large uploads over slow links
+KEEPALIVE_EXPIRY = 120  # seconds an idle Bot API connection stays open (httpx default: 5)
+KEEPALIVE_PING_INTERVAL = 90  # below KEEPALIVE_EXPIRY so the pool never goes cold
+CHAT_ACTION_INTERVAL = 4  # Telegram clears a chat action after ~5s
+YT_PLAYER_CLIENTS = os.environ.get("YT_PLAYER_CLIENTS", "mediaconnect").split(",")
+# Only the sites this bot advertises, plus the generic fallback
+ALLOWED_EXTRACTORS = os.environ.get(
+    "ALLOWED_EXTRACTORS", "youtube.*,facebook.*,instagram.*,generic"
+).split(",")
 
-# --- yt-dlp blocking function ---
-def run_yt_dlp(url: str, output_path: str = "downloads/") -> str:
-    os.makedirs(output_path, exist_ok=True)
+# yt-dlp temp files: <file>.part, <file>.part-Frag<N> and <file>.ytdl
+PARTIAL_RE = re.compile(r"\.(part(-Frag\d+)?|ytdl)$")
+
+# Caps how many yt-dlp jobs run at once; extra requests wait their turn
+DL_SEM = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+# URL -> running download task, so identical links share one download;
+# other URLs for the same video are serialised by video_lock()
+_INFLIGHT = {}
+
+# Idle YoutubeDL instances per output dir; building one registers every
+# extractor, so workers borrow and return them instead of rebuilding
+_YDL_POOL = {}
+_YDL_LOCK = threading.Lock()
+
+# (extractor_key, id) -> [lock, users]; different URLs for the same video
+# must not write the same cache file at once
+_ID_LOCKS = {}
+_ID_LOCKS_LOCK = threading.Lock()
 
+def build_ydl_opts(output_path: str) -> dict:
     cookies_file = "cookies.txt"
+    limit_mb = MAX_FILE_SIZE // (1024 * 1024)
     ydl_opts = {
-        "outtmpl": f"{output_path}%(title)s.%(ext)s",
-        "format": "mp4/best",
+        # keyed by extractor + video id for caching (ids are only unique per site)
+        "outtmpl": f"{output_path}%(extractor_key)s-%(id)s.%(ext)s",
+        "updatetime": False,  # mtime must reflect our own use for LRU eviction
+        # Let yt-dlp pick a rendition that fits the upload limit; the bare
+        # "best" fallback only exists so the probe can report "too large"
+        "format": (
+            f"best[filesize<?{limit_mb}M][filesize_approx<?{limit_mb}M][ext=mp4]"
+            f"/best[filesize<?{limit_mb}M][filesize_approx<?{limit_mb}M]/best"
+        ),
+        "format_sort": [f"size:{limit_mb}M", "res:720", "vcodec:h264"],
         "noplaylist": True,
         "quiet": True,
         "retries": 3,
         "socket_timeout": 30,  # ✅ timeout fix
+        "concurrent_fragment_downloads": FRAGMENT_THREADS,
+        "http_chunk_size": HTTP_CHUNK_SIZE,
+        # Nothing but the media file: no side files, no post-processing
+        "writethumbnail": False,
+        "writeinfojson": False,
+        "writesubtitles": False,
+        "writeautomaticsub": False,
+        "postprocessors": [],
+        "cachedir": False,  # workers would otherwise share ~/.cache/yt-dlp
+        "lazy_playlist": True,
+        "allowed_extractors": ALLOWED_EXTRACTORS,
+        # yt-dlp queries every listed client, so list only the fast one(s);
+        # probe_yt_dlp() retries with the default clients if they fail
+        "extractor_args": {"youtube": {"player_client": YT_PLAYER_CLIENTS}},
     }
     if os.path.exists(cookies_file):
         ydl_opts["cookies"] = cookies_file
+    return ydl_opts
+
+def acquire_ydl(output_path: str) -> yt_dlp.YoutubeDL:
+    with _YDL_LOCK:
+        idle = _YDL_POOL.setdefault(output_path, [])
+        if idle:
+            return idle.pop()
+    return yt_dlp.YoutubeDL(build_ydl_opts(output_path))
+
+def release_ydl(output_path: str, ydl: yt_dlp.YoutubeDL):
+    with _YDL_LOCK:
+        _YDL_POOL[output_path].append(ydl)
+
+@contextmanager
+def video_lock(key: tuple):
+    with _ID_LOCKS_LOCK:
+        entry = _ID_LOCKS.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _ID_LOCKS_LOCK:
+            entry[1] -= 1
+            if not entry[1]:
+                del _ID_LOCKS[key]
+
+# Drop least recently used files once the cache grows past CACHE_MAX_BYTES
+def evict_cache(output_path: str):
+    files = []
+    for name in os.listdir(output_path):
+        if PARTIAL_RE.search(name):
+            continue  # still being written
+        path = os.path.join(output_path, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# Extract metadata; YouTube falls back to yt-dlp's default player clients
+# when the fast ones fail (PO tokens, no formats)
+def probe_yt_dlp(ydl: yt_dlp.YoutubeDL, url: str, output_path: str) -> dict:
+    try:
+        return ydl.extract_info(url, download=False)
+    except yt_dlp.utils.DownloadError:
+        if not ydl.get_info_extractor("Youtube").suitable(url):
+            raise
+        opts = build_ydl_opts(output_path)
+        opts["extractor_args"] = {"youtube": {"player_client": ["default"]}}
+        with yt_dlp.YoutubeDL(opts) as fallback:
+            return fallback.extract_info(url, download=False)
+
+# --- yt-dlp blocking function ---
+def run_yt_dlp(url: str, output_path: str = CACHE_DIR) -> str:
+    os.makedirs(output_path, exist_ok=True)
+
+    ydl = acquire_ydl(output_path)
+    try:
+        # Metadata first; only fetch the media if it isn't cached already
+        info = probe_yt_dlp(ydl, url, output_path)
+        with video_lock((info.get("extractor_key"), info.get("id"))):
+            filepath = ydl.prepare_filename(info)
+            if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+                os.utime(filepath)  # mark as recently used
+                return filepath, info
+
+            # Don't download what we can never upload
+            approx_size = info.get("filesize") or info.get("filesize_approx")
+            if approx_size and approx_size > MAX_FILE_SIZE:
+                return None, info
+
+            info = ydl.process_ie_result(info, download=True)
+            filepath = ydl.prepare_filename(info)
+    finally:
+        release_ydl(output_path, ydl)
+
+    evict_cache(output_path)
+    return filepath, info
+
+# Clear partial files left behind by failed or killed downloads
+def reap_stale_parts(output_path: str):
+    now = time.time()
+    for name in os.listdir(output_path):
+        if not PARTIAL_RE.search(name):
+            continue
+        path = os.path.join(output_path, name)
+        try:
+            if now - os.stat(path).st_mtime > STALE_PART_AGE:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+async def reaper():
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        try:
+            await asyncio.to_thread(reap_stale_parts, CACHE_DIR)
+        except Exception:
+            logging.exception("Cache reaper failed")
+
+# Cheap Bot API call on the main request so its connection never idles out
+async def keepalive(bot):
+    while True:
+        await asyncio.sleep(KEEPALIVE_PING_INTERVAL)
+        try:
+            await bot.get_me()
+        except Exception:
+            logging.debug("Keep-alive ping failed", exc_info=True)
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        filepath = ydl.prepare_filename(info)
-        return filepath, info
+def read_file(filepath: str) -> bytes:
+    with open(filepath, "rb") as f:
+        return f.read()
+
+async def _download(url: str):
+    async with DL_SEM:
+        return await asyncio.to_thread(run_yt_dlp, url)
+
+def download(url: str) -> asyncio.Task:
+    task = _INFLIGHT.get(url)
+    if task is None:
+        task = asyncio.create_task(_download(url))
+        _INFLIGHT[url] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(url, None))
+    return task
+
+# Keep "sending a file..." visible in the chat while the upload runs
+async def upload_ticker(chat):
+    while True:
+        try:
+            await chat.send_action(ChatAction.UPLOAD_DOCUMENT)
+        except Exception:
+            logging.debug("Could not send chat action", exc_info=True)
+        await asyncio.sleep(CHAT_ACTION_INTERVAL)
+
+# Edit the status message, or reply afresh if it can no longer be edited
+async def report(update: Update, status, text: str):
+    try:
+        await status.edit_text(text)
+    except TelegramError:
+        await update.message.reply_text(text)
 
 # /start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -57,23 +271,54 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Handle links
 async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    url = update.message.text.strip()
+    # Telegram has already located the links for us; the handler filter
+    # guarantees a URL entity in either the text or the caption
+    entities = update.message.parse_entities([MessageEntity.URL])
+    entities = entities or update.message.parse_caption_entities([MessageEntity.URL])
+    url = next(iter(entities.values())).strip()
     status = await update.message.reply_text("⏳ Downloading... Please wait.")
 
     try:
-        filepath, info = await asyncio.to_thread(run_yt_dlp, url)
+        # shield() so one user's cancelled handler doesn't kill a shared download
+        filepath, info = await asyncio.shield(download(url))
 
-        if not os.path.exists(filepath):
-            await status.edit_text("⚠️ Could not find downloaded file.")
+        if filepath is None:
+            approx_size = info.get("filesize") or info.get("filesize_approx")
+            await status.edit_text(
+                f"⚠️ File too large for Telegram upload.\n\n"
+                f"Title: {info.get('title', url)}\n"
+                f"Size: ~{approx_size/1024/1024:.2f} MB\n"
+                f"Link: {info.get('webpage_url', url)}"
+            )
             return
 
-        size = os.path.getsize(filepath)
+        # One stat in a worker thread covers both the existence and size checks
+        try:
+            size = (await asyncio.to_thread(os.stat, filepath)).st_size
+        except FileNotFoundError:
+            await status.edit_text("⚠️ Could not find downloaded file.")
+            return
         title = info.get("title", os.path.basename(filepath))
+        ext = os.path.splitext(filepath)[1]
 
         if size <= MAX_FILE_SIZE:
-            with open(filepath, "rb") as f:
-                await update.message.reply_document(f, filename=os.path.basename(filepath))
-            await status.delete()
+            # open+read in one worker thread so the event loop never blocks on disk
+            data = await asyncio.to_thread(read_file, filepath)
+            ticker = asyncio.create_task(upload_ticker(update.message.chat))
+            try:
+                await update.message.reply_document(
+                    data,
+                    filename=f"{yt_dlp.utils.sanitize_filename(title)[:200]}{ext}",
+                    caption=title[:1024],
+                    write_timeout=UPLOAD_WRITE_TIMEOUT,  # per-call default is 20s
+                )
+            finally:
+                ticker.cancel()
+            # Only drop the status once the file is delivered; the caption carries the title
+            try:
+                await status.delete()
+            except TelegramError:
+                logging.debug("Could not delete status message", exc_info=True)
         else:
             await status.edit_text(
                 f"⚠️ File too large for Telegram upload.\n\n"
@@ -82,14 +327,88 @@ async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Link: {info.get('webpage_url', url)}"
             )
     except Exception as e:
-        await status.edit_text(f"❌ Download failed: {str(e)}")
+        await report(update, status, f"❌ Download failed: {str(e)}")
+
+# Plain text without a link
+async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("⚠️ Please send a valid link.")
+
+# Once per process: fixed-size thread pool for to_thread work, the cache
+# reaper, and a keep-alive ping per bot
+def setup_runtime(loop: asyncio.AbstractEventLoop, apps: list) -> list:
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tasks = [loop.create_task(reaper())]
+    tasks += [loop.create_task(keepalive(app.bot)) for app in apps]
+    return tasks
+
+# HTTPXRequest with a longer idle keep-alive; together with keepalive()
+# pings the connection opened at startup stays up for the bot's lifetime
+class KeepAliveRequest(HTTPXRequest):
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs["limits"]
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        return super()._build_client()
+
+async def post_init(app):
+    # initialize() has already called get_me() on the keep-alive pool, so the
+    # DNS/TLS setup is paid at startup rather than on the first user message
+    logging.info("Connected as @%s", app.bot.username)
+
+# Build a bot on the shared download machinery. Bots driven manually on one
+# loop (initialize/start/updater) share it after a single setup_runtime(loop, apps) call
+def build_app(token: str):
+    # HTTP/2 multiplexes API calls over one connection; long write window for uploads
+    request = KeepAliveRequest(
+        connection_pool_size=32,
+        pool_timeout=60,
+        read_timeout=120,
+        write_timeout=UPLOAD_WRITE_TIMEOUT,
+        http_version="2",
+    )
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .request(request)
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        .post_init(post_init)
+        .build()
+    )
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(MessageHandler(
+        (filters.Entity(MessageEntity.URL) | filters.CaptionEntity(MessageEntity.URL)) & ~filters.COMMAND,
+        handle_link,
+    ))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, unknown))
+    return app
 
 # Main
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link))
-    app.run_polling()
+    if not BOT_TOKEN:
+        raise RuntimeError("Please set BOT_TOKEN environment variable.")
+
+    # libuv-backed loop when available (not on Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = build_app(BOT_TOKEN)
+    tasks = setup_runtime(loop, [app])
+    try:
+        app.run_polling(close_loop=False)
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
 
 if __name__ == "__main__":
     main()